@@ -1,115 +1,265 @@
 #!/usr/bin/env python3
+import collections
 import contextlib
-import json
+import errno
+import fcntl
 import logging
 import os
 import re
 import shutil
-import socket
+import stat
 import sys
 import tempfile
+import threading
 import time
 from datetime import datetime
+from operator import itemgetter
 
+import av
 import click
 import ffmpeg
 import gevent
 import gevent.monkey
-from gevent.subprocess import PIPE, STDOUT, Popen, run
+from gevent.pool import Group, Pool
+from gevent.subprocess import DEVNULL, PIPE, STDOUT, Popen, run
 from pacbar import pacbar
-from tendo import singleton
 
-gevent.monkey.patch_all(thread=False)
+# libev-cext is the fastest loop gevent ships, and nothing here resolves
+# hostnames so the blocking resolver saves its threadpool
+gevent.config.loop = "libev-cext"
+gevent.config.resolver = "block"
+# only patch what is used: socket/select for progress, subprocess (and time)
+# so waiting on ffmpeg yields to the other greenlets
+gevent.monkey.patch_all(
+    thread=False, os=False, ssl=False, signal=False, dns=False, queue=False
+)
 
-last_print = None
+# AVCOL_PRI_BT2020 from libavutil's AVColorPrimaries
+_AVCOL_PRI_BT2020 = 9
+# sources every NVDEC/QSV/VAAPI generation decodes, by codec and pixel format.
+# Anything else (10-bit H.264, AV1, old AVI/WMV codecs) may silently fall back
+# to software frames, which the device side scalers reject.
+_HWACCEL_FORMATS = {
+    "h264": frozenset({"yuv420p", "yuvj420p"}),
+    "hevc": frozenset({"yuv420p", "yuv420p10le"}),
+}
+# HDR10+ metadata is on every frame, so the first GOPs are enough to detect it
+_HDR_DETECT_SECONDS = 10
 
+_RES_RE = re.compile(r"(\d+)p\.mp4$")
+_BASE_RE = re.compile(r"(.*\(\d+\))")
+_TITLE_RE = re.compile(r"(.*) \((\d{4})\)")
 
-class DuplicateString(str):
-    def __hash__(self):
-        return hash(str(id(self)))
 
+def _acquire_lock(name):
+    """Take an exclusive ``flock`` so only one instance processes ``name`` at
+    a time, exiting if another instance already holds it.
 
-@contextlib.contextmanager
-def _tmpdir_scope():
-    tmpdir = tempfile.mkdtemp()
+    The lock is held until the process exits.
+
+    Returns:
+        lockfile: the path of the lock file.
+    """
+    lockfile = os.path.join(tempfile.gettempdir(), f"media-processing-{name}.lock")
+    fd = os.open(lockfile, os.O_CREAT | os.O_RDWR, 0o644)
     try:
-        yield tmpdir
-    finally:
-        shutil.rmtree(tmpdir)
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        click.echo(f"Another instance is already running ({lockfile})", err=True)
+        sys.exit(-1)
+    return lockfile
 
 
-def _do_watch_progress(filename, sock, handler):
-    """Function to run in a separate gevent greenlet to read progress
-    events from a unix-domain socket."""
-    connection, client_address = sock.accept()
-    data = b""
+def _pipe_hdr10plus_parser(from_path, *args, duration=None, **kwargs):
+    """Pipe the HEVC bitstream of ``from_path`` into ``hdr10plus_parser``
+    without going through a shell, only the first ``duration`` seconds of
+    it if given.
+
+    Returns:
+        (demux, parser): the ffmpeg and hdr10plus_parser processes.
+    """
+    command = ["ffmpeg", "-loglevel", "panic"]
+    if duration is not None:
+        # as an input option the demuxer stops reading instead of the muxer
+        # dropping packets
+        command += ["-t", str(duration)]
+    command += ["-i", from_path, "-an", "-sn", "-c:v", "copy"]
+    command += ["-vbsf", "hevc_mp4toannexb", "-f", "hevc", "-"]
+    demux = Popen(command, stdout=PIPE)
+    parser = Popen(["hdr10plus_parser", *args, "-"], stdin=demux.stdout, **kwargs)
+    # the parser holds its own copy, so ffmpeg gets SIGPIPE once it exits
+    demux.stdout.close()
+    return demux, parser
+
+
+def _terminate(*processes):
+    """Terminate whichever of ``processes`` still run and reap them all."""
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+        process.wait()
+
+
+def _move(src, dst):
+    """Move a file, renaming it in place when ``src`` and ``dst`` share a
+    filesystem and falling back to ``shutil.copyfile`` (which uses
+    ``sendfile`` on Linux) plus an unlink across filesystems."""
     try:
-        while True:
-            more_data = connection.recv(16)
-            if not more_data:
-                break
-            data += more_data
-            lines = data.split(b"\n")
-            for line in lines[:-1]:
-                line = line.decode()
-                parts = line.split("=")
-                key = parts[0] if len(parts) > 0 else None
-                value = parts[1] if len(parts) > 1 else None
-                handler(key, value)
-            data = lines[-1]
-    finally:
-        connection.close()
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copyfile(src, dst)
+        os.unlink(src)
 
 
-@contextlib.contextmanager
-def _watch_progress(handler):
-    """Context manager for creating a unix-domain socket and listen for
-    ffmpeg progress events.
+def _container_duration(container):
+    """Duration of an opened PyAV ``container`` in microseconds.
+
+    Some containers (raw streams, a few MKV muxers) have no duration in
+    their header, then the longest stream's duration is used instead."""
+    if container.duration is not None:
+        return container.duration * 1_000_000 // av.time_base
+
+    durations = [
+        int(stream.duration * stream.time_base * 1_000_000)
+        for stream in container.streams
+        if stream.duration is not None and stream.time_base is not None
+    ]
+    return max(durations, default=0)
+
+
+def _remove_dir(path):
+    """Remove a source folder, once its files are moved out it usually is
+    empty and a single ``rmdir`` does, only leftovers need ``rmtree``."""
+    try:
+        os.rmdir(path)
+    except OSError:
+        shutil.rmtree(path)
+
+
+def _chmod(path, mode):
+    """``os.chmod`` that skips the write when ``path`` already has ``mode``,
+    a stat is much cheaper than a chmod on network shares."""
+    if stat.S_IMODE(os.stat(path).st_mode) != mode:
+        os.chmod(path, mode)
+
 
-    The socket filename is yielded from the context manager and the
-    socket is closed when the context manager is exited.
+def _list_dir(path):
+    """List a directory, skipping unreadable ones like ``os.walk`` does."""
+    try:
+        with os.scandir(path) as entries:
+            return list(entries)
+    except OSError:
+        return []
+
+
+def _detect_hevc_encoder(candidates):
+    """Return the first of ``candidates`` ffmpeg can encode with, falling
+    back to ``libx265``.
+
+    ``ffmpeg -encoders`` only lists what ffmpeg was built with, so every
+    listed encoder also gets a tiny test encode to make sure the hardware
+    behind it is actually present."""
+    result = run(["ffmpeg", "-hide_banner", "-encoders"], stdout=PIPE, stderr=DEVNULL)
+    available = result.stdout.decode().split()
+
+    for encoder in candidates:
+        if encoder not in available:
+            continue
+        test = run(
+            [
+                "ffmpeg",
+                "-hide_banner",
+                "-v",
+                "fatal",
+                "-f",
+                "lavfi",
+                "-i",
+                "color=size=256x256:duration=0.1",
+                "-c:v",
+                encoder,
+                "-f",
+                "null",
+                "-",
+            ],
+            stdout=DEVNULL,
+            stderr=DEVNULL,
+        )
+        if test.returncode == 0:
+            return encoder
+
+    return "libx265"
+
+
+def _to_args(options):
+    """ffmpeg command line arguments for an ``{option: value}`` dict, a
+    ``None`` value is a flag without an argument."""
+    args = []
+    for option, value in options.items():
+        args.append(f"-{option}")
+        if value is not None:
+            args.append(str(value))
+    return args
 
-    Args:
-        handler: a function to be called when progress events are
-            received; receives a ``key`` argument and ``value``
-            argument. (The example ``show_progress`` below uses tqdm)
 
-    Yields:
-        socket_filename: the name of the socket file.
+def _read_progress(pipe, handler):
+    """Function to run in a separate gevent greenlet to pass the ffmpeg
+    progress events read from ``pipe`` to ``handler``."""
+    for line in pipe:
+        key, _, value = line.decode().rstrip("\n").partition("=")
+        handler(key, value)
+
+
+def _run_with_progress(argv, handler):
+    """Run the ffmpeg command line ``argv``, passing its progress events to
+    ``handler``.
+
+    ffmpeg writes its progress straight into a stdout pipe that a greenlet
+    reads, while stderr is drained here.
+
+    Raises:
+        ffmpeg.Error: if ffmpeg exits with a non-zero status.
     """
-    with _tmpdir_scope() as tmpdir:
-        socket_filename = os.path.join(tmpdir, "sock")
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        with contextlib.closing(sock):
-            sock.bind(socket_filename)
-            sock.listen(1)
-            child = gevent.spawn(_do_watch_progress, socket_filename, sock, handler)
-            try:
-                yield socket_filename
-            except Exception:
-                gevent.kill(child)
-                raise
+    process = Popen([*argv, "-progress", "pipe:1"], stdout=PIPE, stderr=PIPE)
+    reader = gevent.spawn(_read_progress, process.stdout, handler)
+    try:
+        # drain stderr while the greenlet reads stdout so neither pipe can
+        # fill up and stall ffmpeg
+        stderr = process.stderr.read()
+        process.wait()
+        reader.get()
+    finally:
+        # a killed encode must not leave ffmpeg writing into the library
+        reader.kill()
+        _terminate(process)
+    if process.returncode:
+        raise ffmpeg.Error("ffmpeg", b"", stderr)
 
 
 @contextlib.contextmanager
 def show_progress(total_duration, proc=None, seek=False):
-    """Create a unix-domain socket to watch progress and render tqdm
-    progress bar."""
-    global last_print
-
+    """Render a progress bar, yielding the handler to feed ffmpeg progress
+    events to."""
+    # per call, parallel jobs each log their own encode's progress
     last_print = time.monotonic()
     with pacbar(length=total_duration) as bar:
         if seek:
             bar.label = "seeking..."
 
         def handler(key, value):
-            global last_print
+            nonlocal last_print
 
             if key == "out_time_ms":
-                out_time = int(value)
+                try:
+                    out_time = int(value)
+                except ValueError:
+                    # N/A until the first frame is written
+                    return
                 bar.update(out_time - bar.pos)
 
-                if proc is not None:
+                if proc is not None and total_duration:
                     now = time.monotonic()
                     if (now - last_print) > 300:
                         proc._log(f"encode progress {out_time/total_duration * 100}")
@@ -121,8 +271,7 @@ def show_progress(total_duration, proc=None, seek=False):
                 if bar.label != "seeking..." or bar.pos > 0:
                     bar.label = f"{value:>7}"
 
-        with _watch_progress(handler) as socket_filename:
-            yield socket_filename
+        yield handler
 
 
 class Processor(object):
@@ -134,9 +283,11 @@ class Processor(object):
     delete = True
     logger = None
     threads = 0
+    jobs = 1
     sample = False
+    highest_only = False
 
-    allowed_extensions = {"mkv", "mp4", "avi", "m4v", "wmv", "m2ts"}
+    allowed_extensions = frozenset(("mkv", "mp4", "avi", "m4v", "wmv", "m2ts"))
     files_to_process = []
 
     video_resolutions = {
@@ -146,6 +297,59 @@ class Processor(object):
         480: {"width": 720, "height": 480},
     }
 
+    # hardware HEVC encoders with the options that replace libx265's
+    # preset/crf/x265-params for each of them. Those with a ``scale_filter``
+    # decode and scale on the device, so frames never leave GPU memory, when
+    # the source is in _HWACCEL_FORMATS; other sources are decoded and scaled
+    # on the CPU with ``software_input_options`` and ``software_scale``.
+    hardware_encoders = {
+        "hevc_nvenc": {
+            "input_options": {"hwaccel": "cuda", "hwaccel_output_format": "cuda"},
+            "scale_filter": "scale_cuda",
+            "scale_format": "p010le",
+            "software_input_options": {},
+            "software_scale": "scale={width}:-2:flags=lanczos,format=p010le",
+            "output_options": {
+                "preset:v": "p5",
+                "rc:v": "vbr",
+                "cq:v": 22,
+                "b:v": 0,
+            },
+        },
+        "hevc_qsv": {
+            "input_options": {"hwaccel": "qsv", "hwaccel_output_format": "qsv"},
+            "scale_filter": "scale_qsv",
+            "scale_format": "p010",
+            "software_input_options": {},
+            "software_scale": "scale={width}:-2:flags=lanczos,format=p010",
+            "output_options": {"preset:v": "veryfast", "global_quality:v": 22},
+        },
+        "hevc_vaapi": {
+            "input_options": {
+                "hwaccel": "vaapi",
+                "hwaccel_device": "/dev/dri/renderD128",
+                "hwaccel_output_format": "vaapi",
+            },
+            "scale_filter": "scale_vaapi",
+            "scale_format": "p010",
+            # hevc_vaapi only takes VAAPI frames, so upload the CPU scaled ones
+            "software_input_options": {
+                "init_hw_device": "vaapi=va:/dev/dri/renderD128",
+                "filter_hw_device": "va",
+            },
+            "software_scale": "scale={width}:-2:flags=lanczos,format=p010,hwupload",
+            "output_options": {"rc_mode:v": "CQP", "qp:v": 22},
+        },
+        "hevc_videotoolbox": {
+            "input_options": {},
+            "scale_filter": None,
+            "output_options": {"q:v": 65, "pix_fmt:v": "p010le"},
+        },
+    }
+    # what ``--encoder auto`` tries, in order of preference; VAAPI cannot be
+    # probed with a plain software test encode, so it has to be asked for
+    auto_encoders = ("hevc_nvenc", "hevc_qsv", "hevc_videotoolbox")
+
     def __init__(
         self,
         path,
@@ -157,6 +361,10 @@ class Processor(object):
         no_delete,
         log_file,
         threads,
+        jobs,
+        highest_only,
+        encoder,
+        lock_file,
     ):
         self.path = path
         self.output_path = output_path
@@ -166,8 +374,31 @@ class Processor(object):
         self.fake = fake
         self.sample = sample
         self.delete = not no_delete
-        self.lock = singleton.SingleInstance("moveis")
+        self.highest_only = highest_only
+        self.lock_file = lock_file
         self.threads = threads
+        # a real lock, _log is also called from the hub's threadpool
+        self._log_lock = threading.Lock()
+        self._ts_sec = 0
+        self._ts_str = ""
+        self._log_lines = collections.deque()
+        self._probe_cache = {}
+        self._ensured_dirs = set()
+        self._pending_io = []
+        self._hdr_checks = {}
+        self._encode_templates = {}
+        if encoder == "auto":
+            self._hevc_encoder = _detect_hevc_encoder(self.auto_encoders)
+        else:
+            self._hevc_encoder = encoder
+
+        if jobs > 0:
+            self.jobs = jobs
+        elif self.threads > 0:
+            self.jobs = max(1, (os.cpu_count() or 1) // self.threads)
+        else:
+            # ffmpeg already uses every core when left to pick its own threads
+            self.jobs = 1
 
         if log_file is not None:
             self.logger = logging.getLogger("download_media")
@@ -182,41 +413,83 @@ class Processor(object):
         self._log(f"    Output Directory : {self.output_path}")
         self._log(f"             Dry Run : {self.dry_run}")
         self._log(f"              Delete : {self.delete}")
+        self._log(f"        Highest Only : {self.highest_only}")
         self._log(f"      Verbose Output : {self.verbose}")
-        self._log(f"           Lock File : {self.lock.lockfile}")
+        self._log(f"           Lock File : {self.lock_file}")
         self._log(f"         CPU Threads : {self.threads}")
+        self._log(f"       Parallel Jobs : {self.jobs}")
+        self._log(f"       Video Encoder : {self._hevc_encoder}")
 
         if log_file is not None:
             self._log(f"              Logger : {log_file}")
         self._log()
 
-    def _log(self, message=""):
-        now = time.strftime("%Y-%m-%d %H:%M:%S")
-        click.echo(f"{now} {message}")
+    def _log(self, *messages):
+        """Queue every message as its own timestamped line, ``_flush_log``
+        writes them out in batches."""
+        if not messages:
+            messages = ("",)
+
+        with self._log_lock:
+            # strftime only changes once a second, so only format it then
+            now = int(time.time())
+            if now != self._ts_sec:
+                self._ts_sec = now
+                self._ts_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))
+
+            for message in messages:
+                self._log_lines.append((self._ts_str, str(message)))
+
+    def _flush_log(self):
+        """Write every queued log line with a single echo (and log record)."""
+        lines = []
+        # popleft is thread safe, the threadpool may still be appending
+        while self._log_lines:
+            lines.append(self._log_lines.popleft())
+        if not lines:
+            return
 
+        click.echo("\n".join("%s %s" % line for line in lines))
         if self.logger is not None:
-            self.logger.info(message)
+            self.logger.info("\n".join(message for _, message in lines))
+
+    def _flush_log_loop(self):
+        while True:
+            gevent.sleep(0.1)
+            self._flush_log()
 
     def _find_files(self):
-        allowed_extensions = self.allowed_extensions
+        found = collections.deque()
+        group = Group()
+        group.spawn(self._scandir_walk, self.path, group, found)
+        group.join(raise_error=True)
 
-        files_to_check = {}
+        files_to_check = collections.defaultdict(list)
 
-        for root, _, files in os.walk(self.path):
-            for name in files:
-                file_parts = name.split(".")
-                file_path = os.path.join(root, name)
-                if file_parts[-1] in allowed_extensions:
-                    if root not in files_to_check:
-                        files_to_check[root] = []
-                    files_to_check[root].append(name)
-                    self._log(f"Found unknown file: {file_path}")
+        for root, name in sorted(found):
+            files_to_check[root].append(name)
+            self._log(f"Found unknown file: {os.path.join(root, name)}")
 
         self._check_movies(files_to_check)
         self._log(f"Found {len(self.files_to_process)} files to process")
         if self.verbose:
             self._log(self.files_to_process)
 
+    def _scandir_walk(self, root, group, found):
+        allowed_extensions = self.allowed_extensions
+
+        # directory reads block, so run them on the hub's threadpool to let
+        # sibling directories be listed concurrently
+        entries = gevent.get_hub().threadpool.apply(_list_dir, (root,))
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                # unbounded group, a bounded pool could deadlock with every
+                # slot held by a parent waiting to spawn its children
+                group.spawn(self._scandir_walk, entry.path, group, found)
+            elif entry.is_file():
+                if entry.name.rpartition(".")[2].lower() in allowed_extensions:
+                    found.append((root, entry.name))
+
     def _check_movies(self, files_to_check):
         for root_path, files in files_to_check.items():
             if len(files) > 1:
@@ -230,26 +503,24 @@ class Processor(object):
                 for file_name in files:
                     file_path = os.path.join(root_path, file_name)
                     if self.delete:
-                        self._run(f'os.remove("{file_path}")')
+                        self._run(os.remove, file_path)
                 self.files_to_process.append(os.path.join(root_path, master))
             else:
                 self.files_to_process.append(os.path.join(root_path, files[0]))
 
     def _find_highest_res(self, files):
-        highest_res = 0
+        candidates = []
+        master_file = None
         for file_name in files:
-            if not (file_name.endswith("p.mp4")):
+            match = _RES_RE.search(file_name)
+            if match is None:
+                # an untagged original always wins, the tagged files next to
+                # it may be partial outputs of a failed encode
                 master_file = file_name
                 break
-            match = re.search(r"(\d+)p.mp4", file_name)
-            res = int(match.group(1))
-            if res > highest_res:
-                highest_res = res
-        if highest_res > 0:
-            for file_name in files:
-                if file_name.endswith(f"{highest_res}p.mp4"):
-                    master_file = file_name
-                    break
+            candidates.append((int(match.group(1)), file_name))
+        if master_file is None:
+            master_file = max(candidates, key=itemgetter(0))[1]
 
         if self.verbose:
             self._log(f"master file found: {master_file}")
@@ -258,11 +529,47 @@ class Processor(object):
     def _process_files(self):
         self._log(f"Processing {len(self.files_to_process)} files\n")
         total = len(self.files_to_process)
-        current = 0
-        for file_path in self.files_to_process.copy():
-            current += 1
-            self._process_movie_file(file_path, total, current)
-            self.files_to_process.remove(file_path)
+        pool = Pool(size=self.jobs)
+        files = self.files_to_process
+        greenlets = []
+        for current, file_path in enumerate(files, 1):
+            greenlets.append(
+                pool.spawn(self._process_movie_file, file_path, total, current)
+            )
+            if current < total:
+                # detect the next file's HDR while the pool is busy encoding
+                self._start_hdr_check(files[current])
+        try:
+            # a failing file does not stop the others, the first error is
+            # raised once every encode is done. The pool forgets finished
+            # greenlets, so join(raise_error=True) would miss earlier ones.
+            pool.join()
+            for greenlet in greenlets:
+                greenlet.get()
+            files.clear()
+        finally:
+            # only does anything when the join itself was interrupted (e.g.
+            # Ctrl+C), killing an encode also stops its ffmpeg
+            pool.kill()
+
+            # checks for files that were skipped before their encode, stopped
+            # first so a failed move below cannot leave them running
+            hdr_checks, self._hdr_checks = self._hdr_checks, {}
+            for hdr_check, metadata_path in hdr_checks.values():
+                hdr_check.kill()
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(metadata_path)
+
+            # wait for every move, not just up to the first failing one
+            pending_io, self._pending_io = self._pending_io, []
+            io_errors = []
+            for result in pending_io:
+                try:
+                    result.get()
+                except Exception as e:
+                    io_errors.append(e)
+            if io_errors:
+                raise io_errors[0]
 
     def _process_movie_file(self, file_path, total, current):
         filename = os.path.basename(file_path)
@@ -270,11 +577,13 @@ class Processor(object):
         file_folder = base_input.split(os.sep)[-1]
 
         if self.verbose:
-            self._log(f"  file_path : {file_path}")
-            self._log(f"   filename : {filename}")
-            self._log(f" base_input : {base_input}")
-            self._log(f"file_folder : {file_folder}")
-            self._log(f"output_path : {self.output_path}")
+            self._log(
+                f"  file_path : {file_path}",
+                f"   filename : {filename}",
+                f" base_input : {base_input}",
+                f"file_folder : {file_folder}",
+                f"output_path : {self.output_path}",
+            )
 
         original_resolution = self._probe_file(file_path)
 
@@ -285,104 +594,201 @@ class Processor(object):
             f"({current}/{total}) {filename} - " f"source: {original_resolution}p"
         )
 
-        base_name = re.match(r"(.*\(\d+\))", filename).group(1)
-        source_file = filename
+        base_match = _BASE_RE.match(filename)
+        title_parse = base_match and _TITLE_RE.match(base_match.group(1))
+        if title_parse is None:
+            self._log(f"No title (year) in file name: {file_path}\n")
+            return
+
+        base_name = base_match.group(1)
+        is_processed = filename.endswith(f" - {original_resolution}p.mp4")
+
+        title = title_parse.group(1)
+        release_year = title_parse.group(2)
+        if title.endswith(", The"):
+            title = f"The {title[:-5]}"
+
+        outputs = {
+            resolution: os.path.join(base_input, f"{base_name} - {resolution}p.mp4")
+            for resolution in self._plan_resolutions(original_resolution, is_processed)
+        }
 
         if self.verbose:
-            self._log(f"  base_name : {base_name}")
-            self._log(f"source_file : {source_file}")
+            self._log(
+                f"   base_name : {base_name}",
+                f"is_processed : {is_processed}",
+                f"       title : {title}",
+                *(
+                    f"{resolution:>11}p : {to_path}"
+                    for resolution, to_path in outputs.items()
+                ),
+            )
 
-        current_resolution = original_resolution
-        for res in self.video_resolutions.values():
-            target_resolution = res["height"]
-            if target_resolution == 480 and original_resolution > 480:
+        if outputs:
+            self._encode_video(file_path, outputs, title, release_year)
+
+        # move the files on the hub's threadpool so big copies overlap the next
+        # encode instead of delaying it
+        self._pending_io.append(
+            gevent.get_hub().threadpool.spawn(
+                self._finish_movie,
+                file_path,
+                outputs,
+                original_resolution,
+                is_processed,
+                file_folder,
+            )
+        )
+
+    def _finish_movie(
+        self, file_path, outputs, original_resolution, is_processed, file_folder
+    ):
+        """Move a movie's source and encoded ``outputs`` into the libraries."""
+        if is_processed:
+            self._place_file(
+                file_path, self._library_name(original_resolution), file_folder
+            )
+        elif original_resolution == 2160:
+            self._place_file(file_path, "orig", file_folder)
+        elif self.delete:
+            self._run(os.remove, file_path)
+
+        for resolution, to_path in outputs.items():
+            self._place_file(to_path, self._library_name(resolution), file_folder)
+
+        if self.delete:
+            self._run(_remove_dir, os.path.dirname(file_path))
+
+    def _plan_resolutions(self, original_resolution, is_processed):
+        """Resolutions to encode a source into, a processed source already is
+        its own resolution's output."""
+        resolutions = []
+        for resolution in self.video_resolutions:
+            if resolution == 480 and original_resolution > 480:
                 if self.verbose:
                     self._log("source resolution HD or better, skipping SD encode")
-            elif current_resolution >= target_resolution:
-                current_resolution, source_file = self._process_resolution(
-                    target_resolution,
-                    current_resolution,
-                    source_file,
-                    base_name,
-                    base_input,
-                    self.output_path,
-                    file_folder,
-                )
+            elif resolution <= original_resolution:
+                resolutions.append(resolution)
 
-        base_output = os.path.join(self.output_path, "main", file_folder)
-        os.makedirs(base_output, exist_ok=True)
-        os.chmod(base_output, 0o775)
-        from_path = os.path.join(base_input, source_file)
-        to_path = os.path.join(base_output, source_file)
+        if self.highest_only:
+            resolutions = resolutions[:1]
+        if is_processed:
+            resolutions = [r for r in resolutions if r != original_resolution]
+        return resolutions
+
+    def _library_name(self, resolution):
+        return "2160p" if resolution == 2160 else "main"
+
+    def _place_file(self, from_path, library_name, file_folder):
+        base_output = os.path.join(self.output_path, library_name, file_folder)
+        self._ensure_dir(base_output)
+        to_path = os.path.join(base_output, os.path.basename(from_path))
         if self.delete:
-            self._run(f'shutil.move("{from_path}", "{to_path}")')
+            self._run(_move, from_path, to_path)
         else:
-            self._run(f'shutil.copyfile("{from_path}", "{to_path}")')
-        self._run(f'os.chmod("{to_path}", 0o664)')
-        if self.delete:
-            self._run(f'shutil.rmtree("{base_input}")')
+            self._run(shutil.copyfile, from_path, to_path)
+        self._run(_chmod, to_path, 0o664)
+
+    def _ensure_dir(self, path):
+        if path in self._ensured_dirs:
+            return
+        self._run(os.makedirs, path, 0o775, True)
+        self._run(_chmod, path, 0o775)
+        self._ensured_dirs.add(path)
 
     def _process_music_file(self, file_path, total, current):
         filename = os.path.basename(file_path)
         directory = os.path.dirname(file_path)
 
-        to_path = os.path.join(directory, filename.replace("flac", "mp3"))
+        # only swap the extension, "flac" may also be part of the name itself
+        to_path = os.path.join(directory, f"{filename.rpartition('.')[0]}.mp3")
 
         if self.verbose:
-            self._log(f" file_path : {file_path}")
-            self._log(f"  filename : {filename}")
-            self._log(f" directory : {directory}")
-            self._log(f"   to_path : {to_path}")
+            self._log(
+                f" file_path : {file_path}",
+                f"  filename : {filename}",
+                f" directory : {directory}",
+                f"   to_path : {to_path}",
+            )
 
         self._log(f"({current}/{total}) {filename}")
 
         if not self.dry_run:
-            total_duration = int(
-                float(ffmpeg.probe(file_path)["format"]["duration"]) * 1_000_000
-            )
+            total_duration = self._probe(file_path)["duration"]
 
             options = {
                 "y": None,
                 "v": "fatal",
-                "stats": None,
+                "nostats": None,
                 "hide_banner": None,
                 "ab": "320k",
                 "map_metadata": 0,
                 "id3v2_version": 3,
             }
 
-            with show_progress(total_duration) as socket_filename:
+            with show_progress(total_duration) as handler:
                 try:
-                    (
-                        ffmpeg.input(file_path)
-                        .output(to_path, **options)
-                        .global_args("-progress", "unix://{}".format(socket_filename))
-                        .run(capture_stdout=True, capture_stderr=True)
+                    _run_with_progress(
+                        ffmpeg.input(file_path).output(to_path, **options).compile(),
+                        handler,
                     )
                 except ffmpeg.Error as e:
+                    self._flush_log()
                     print("ffmpeg error")
                     print(e.stderr, file=sys.stderr)
-                    sys.exit(1)
-        self._run(f'os.chmod("{to_path}", 0o664)')
+                    # other jobs may still be encoding, main exits once they
+                    # are done
+                    raise
+        self._run(_chmod, to_path, 0o664)
 
         if self.delete:
-            self._run(f'os.remove("{file_path}")')
+            self._run(os.remove, file_path)
+
+    def _probe(self, file_path):
+        """Probe ``file_path`` in-process with libavformat, once per file.
+
+        Returns a dict with the first video stream's ``width``, ``height``,
+        ``color_primaries``, ``codec`` and ``pix_fmt`` (all ``None`` without a
+        video stream), the ``duration`` in microseconds and the
+        ``audio_streams`` as ``(index, language)`` pairs.
+        """
+        probe = self._probe_cache.get(file_path)
+        if probe is None:
+            with av.open(file_path) as container:
+                video_stream = next(iter(container.streams.video), None)
+                probe = {
+                    "width": None,
+                    "height": None,
+                    "color_primaries": None,
+                    "codec": None,
+                    "pix_fmt": None,
+                    "duration": _container_duration(container),
+                    "audio_streams": [
+                        (stream.index, stream.metadata.get("language"))
+                        for stream in container.streams.audio
+                    ],
+                }
+                if video_stream is not None:
+                    codec_context = video_stream.codec_context
+                    probe["width"] = codec_context.width
+                    probe["height"] = codec_context.height
+                    probe["color_primaries"] = codec_context.color_primaries
+                    probe["codec"] = codec_context.name
+                    probe["pix_fmt"] = codec_context.pix_fmt
+            self._probe_cache[file_path] = probe
+        return probe
 
     def _probe_file(self, file_path):
         current_resolution = -1
         if self.verbose:
             self._log(f"probing {file_path}")
-        probe = ffmpeg.probe(file_path)
-        video_stream = next(
-            (stream for stream in probe["streams"] if stream["codec_type"] == "video"),
-            None,
-        )
+        probe = self._probe(file_path)
 
-        if video_stream is None:
+        if probe["width"] is None:
             self._log(f"No video stream: {file_path}\n")
             return -1
 
-        width = int(video_stream["width"])
+        width = probe["width"]
         for res in self.video_resolutions.values():
             if width > (res["width"] - 10):
                 current_resolution = res["height"]
@@ -390,140 +796,66 @@ class Processor(object):
 
         return current_resolution
 
-    def _process_resolution(
-        self,
-        target_resolution,
-        current_resolution,
-        source_file,
-        base_name,
-        base_input,
-        output_path,
-        file_folder,
-    ):
-
-        is_processed = source_file.endswith(f" - {current_resolution}p.mp4")
-        output_file = f"{base_name} - {target_resolution}p.mp4"
-        from_path = os.path.join(base_input, source_file)
-        to_path = os.path.join(base_input, output_file)
-        output_file = f"{base_name} - {target_resolution}p.mp4"
-
-        title_parse = re.match(r"(.*) \((\d{4})\)", base_name)
-        title = title_parse.group(1)
-        release_year = title_parse.group(2)
-        if title.endswith(", The"):
-            title = f"The {title[:-5]}"
-
-        if self.verbose:
-            self._log(f"target_resolution : {target_resolution}")
-            self._log(f"     is_processed : {is_processed}")
-            self._log(f"      output_file : {output_file}")
-            self._log(f"        from_path : {from_path}")
-            self._log(f"      output_path : {output_path}")
-            self._log(f"          to_path : {to_path}")
-            self._log(f"      output_file : {output_file}")
-            self._log(f"            title : {title}")
-
-        if is_processed and current_resolution == target_resolution:
-            return target_resolution, source_file
-
-        self._encode_video(from_path, to_path, target_resolution, title, release_year)
-
-        if current_resolution == 2160:
-            library_name = "2160p"
-        else:
-            library_name = "main"
-        base_output = os.path.join(output_path, library_name, file_folder)
-        orig_output = os.path.join(output_path, "orig", file_folder)
+    def _start_hdr_check(self, from_path):
+        """Start checking ``from_path`` for HDR in its own greenlet, so the
+        HDR10+ pipeline can run while another file is still encoding."""
+        if from_path in self._hdr_checks:
+            return
+        # per file so parallel jobs do not clobber each other's metadata
+        metadata_fd, metadata_path = tempfile.mkstemp(suffix=".json")
+        os.close(metadata_fd)
+        self._hdr_checks[from_path] = (
+            gevent.spawn(self._check_hdr, from_path, metadata_path),
+            metadata_path,
+        )
 
-        if is_processed:
-            os.makedirs(base_output, exist_ok=True)
-            os.chmod(base_output, 0o775)
-            source_to_path = os.path.join(base_output, source_file)
-        else:
-            if target_resolution == 2160:
-                os.makedirs(orig_output, exist_ok=True)
-                os.chmod(orig_output, 0o775)
-            source_to_path = os.path.join(orig_output, source_file)
+    def _check_hdr(self, from_path, metadata_path):
+        # HDR10+ is always BT.2020, so SDR sources skip reading the bitstream
+        if self._probe(from_path)["color_primaries"] != _AVCOL_PRI_BT2020:
+            return None
 
-        if self.delete:
-            if is_processed or target_resolution == 2160:
-                self._run(f'shutil.move("{from_path}", "{source_to_path}")')
-                self._run(f'os.chmod("{source_to_path}", 0o664)')
-            else:
-                self._run(f'os.remove("{from_path}")')
-        elif is_processed or target_resolution == 2160:
-            self._run(f'shutil.copyfile("{from_path}", "{source_to_path}")')
-            self._run(f'os.chmod("{source_to_path}", 0o664)')
-
-        return target_resolution, output_file
-
-    def _check_hdr(self, from_path):
-        p = Popen(
-            f'ffmpeg -loglevel panic -i "{from_path}" -c:v copy -vbsf hevc_mp4toannexb -f hevc - | hdr10plus_parser --verify -',
-            shell=True,
-            stdin=PIPE,
+        demux, parser = _pipe_hdr10plus_parser(
+            from_path,
+            "--verify",
+            duration=_HDR_DETECT_SECONDS,
             stdout=PIPE,
             stderr=STDOUT,
-            close_fds=True,
         )
-        output = p.stdout.read().decode("utf8")
-
-        dynamic_hdr = None
-        if "Dynamic HDR10+ metadata detected." in output:
-            dynamic_hdr = True
-            run(
-                f'ffmpeg -i "{from_path}" -c:v copy -vbsf hevc_mp4toannexb -f hevc - | hdr10plus_parser -o /tmp/metadata.json -',
-                shell=True,
-            )
-        else:
-            p = Popen(
-                f'ffprobe -v error -show_streams -select_streams v:0 -of json -i "{from_path}"',
-                shell=True,
-                stdin=PIPE,
-                stdout=PIPE,
-                stderr=STDOUT,
-                close_fds=True,
-            )
+        dynamic_hdr = False
+        try:
+            for line in parser.stdout:
+                if b"Dynamic HDR10+ metadata detected." in line:
+                    dynamic_hdr = True
+                    break
+        finally:
+            # the answer is known, do not demux the rest of the file for it
+            _terminate(parser, demux)
+            parser.stdout.close()
 
+        if dynamic_hdr:
+            demux, parser = _pipe_hdr10plus_parser(from_path, "-o", metadata_path)
             try:
-                output = json.loads(p.stdout.read().decode("utf8"))
-            except json.decoder.JSONDecodeError:
-                pass
-            else:
-                streams = output.get("streams", [{}])
-
-                if len(streams) > 0 and streams[0].get("color_primaries") == "bt2020":
-                    dynamic_hdr = False
+                parser.wait()
+                demux.wait()
+            finally:
+                # killed by _process_files, stop writing the metadata file
+                # before it gets removed
+                _terminate(parser, demux)
 
         return dynamic_hdr
 
     def _get_audio_track(self, from_path):
-        p = Popen(
-            f'ffprobe -v error -show_entries stream=index:stream_tags=language -select_streams a -of json -i "{from_path}"',
-            shell=True,
-            stdin=PIPE,
-            stdout=PIPE,
-            stderr=STDOUT,
-            close_fds=True,
-        )
-
         track = 0
         language = None
 
-        try:
-            output = json.loads(p.stdout.read().decode("utf8"))
-        except json.decoder.JSONDecodeError:
-            pass
-        else:
-            for index, stream in enumerate(output["streams"]):
-                lang = stream.get("tags", {}).get("language")
+        audio_streams = self._probe(from_path)["audio_streams"]
+        for index, (stream_index, lang) in enumerate(audio_streams):
+            if lang == "eng" or index == 0:
+                track = stream_index - 1
+                language = lang
 
-                if lang == "eng" or index == 0:
-                    track = stream.get("index", index + 1) - 1
-                    language = lang
-
-                    if language == "eng":
-                        break
+                if language == "eng":
+                    break
 
         if language is None:
             language = "eng"
@@ -532,119 +864,212 @@ class Processor(object):
             self._log(f"could not find English audio track. Found: {language}")
         return language, track
 
-    def _encode_video(self, from_path, to_path, target_resolution, title, release_year):
-        width = self.video_resolutions[target_resolution]["width"]
+    def _encode_video(self, from_path, outputs, title, release_year):
+        """Encode ``from_path`` into every ``{resolution: to_path}`` of
+        ``outputs`` with a single ffmpeg run, so the source is only decoded
+        once and split between the scaled outputs."""
+        self._start_hdr_check(from_path)
+        hdr_check, metadata_path = self._hdr_checks.pop(from_path)
+        try:
+            language, track = self._get_audio_track(from_path)
+            total_duration = self._probe(from_path)["duration"]
+            dynamic_hdr = hdr_check.get()
+            hdr_string = (
+                "none" if dynamic_hdr is None else ("yes" if dynamic_hdr else "no")
+            )
 
-        dynamic_hdr = self._check_hdr(from_path)
-        hdr_string = "none" if dynamic_hdr is None else ("yes" if dynamic_hdr else "no")
-        language, track = self._get_audio_track(from_path)
+            # the HDR10+ dynamic metadata can only be passed through x265-params,
+            # which the hardware encoders do not understand
+            encoder = "libx265" if dynamic_hdr else self._hevc_encoder
+
+            resolutions = ", ".join(f"{resolution}p" for resolution in outputs)
+            self._log(f"    encode (hdr: {hdr_string}): {from_path} -> {resolutions}")
+            if self.verbose:
+                self._log(
+                    f"        from_path : {from_path}",
+                    *(
+                        f"{resolution:>16}p : {to_path} "
+                        f"(width: {self.video_resolutions[resolution]['width']})"
+                        for resolution, to_path in outputs.items()
+                    ),
+                    f"             hdr  : {hdr_string}",
+                    f"          encoder : {encoder}",
+                    f"            title : {title}",
+                    f"      audio track : {track}",
+                )
 
-        self._log(f"    encode (hdr: {hdr_string}): {from_path} -> {to_path}")
-        if self.verbose:
-            self._log(f"        from_path : {from_path}")
-            self._log(f"          to_path : {to_path}")
-            self._log(f"target_resolution : {target_resolution}")
-            self._log(f"             hdr  : {hdr_string}")
-            self._log(f"            width : {width}")
-            self._log(f"            title : {title}")
-            self._log(f"      audio track : {track}")
-
-        total_duration = int(
-            float(ffmpeg.probe(from_path)["format"]["duration"]) * 1_000_000
-        )
+            probe = self._probe(from_path)
+            device_decode = probe["pix_fmt"] in _HWACCEL_FORMATS.get(probe["codec"], ())
+            template = self._encode_template(encoder, dynamic_hdr, device_decode)
+            seek_args = []
+            seek = False
+            if self.sample and not from_path.endswith("p.mp4"):
+                seek_args = ["-ss", "00:03:30", "-t", "30"]
+                total_duration = 30_000_000
+                seek = True
+
+            file_args = [
+                "-metadata",
+                f"title={title}",
+                "-metadata",
+                f"year={release_year}",
+                "-metadata:s:a:0",
+                f"language={language}",
+            ]
+            if template["x265_params"] is not None:
+                x265_params = template["x265_params"]
+                if dynamic_hdr:
+                    x265_params += f":dhdr10-info={metadata_path}"
+                file_args += ["-x265-params", x265_params]
+
+            # split the decoded source between one scaler per output
+            labels = "".join(f"[s{index}]" for index in range(len(outputs)))
+            graph = [f"[0:v]split={len(outputs)}{labels}"]
+            output_args = []
+            for index, (resolution, to_path) in enumerate(outputs.items()):
+                width = self.video_resolutions[resolution]["width"]
+                graph.append(
+                    f"[s{index}]{template['scale'].format(width=width)}[v{index}]"
+                )
+                output_args += ["-map", f"[v{index}]", "-map", f"0:a:{track}"]
+                output_args += [*template["output_args"], *file_args, to_path]
+
+            argv = ["ffmpeg", *template["input_args"], *seek_args, "-i", from_path]
+            argv += ["-filter_complex", ";".join(graph), *output_args]
+
+            with show_progress(total_duration, self, seek=seek) as handler:
+                try:
+                    if self.dry_run:
+                        self._log(" ".join(argv))
+                        if self.fake:
+                            import time
+
+                            bar = pacbar(length=5)
+                            for x in range(5):
+                                time.sleep(1)
+                                bar.update(1)
+                            bar.render_finish()
+                    else:
+                        _run_with_progress(argv, handler)
+                except BaseException as e:
+                    # every output is written at once, do not leave partial files
+                    # behind for the next run to mistake for finished encodes,
+                    # also when the encode was killed
+                    for to_path in outputs.values():
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(to_path)
+                    if isinstance(e, ffmpeg.Error):
+                        self._flush_log()
+                        print("ffmpeg error")
+                        print(e.stderr, file=sys.stderr)
+                    # other jobs may still be encoding, main exits once they
+                    # are done
+                    raise
+        finally:
+            # the check may still be extracting when the encode failed early
+            hdr_check.kill()
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(metadata_path)
+
+    def _encode_template(self, encoder, hdr, device_decode):
+        """The parts of an encode's command line that only depend on
+        ``encoder``, ``hdr`` (the ``_check_hdr`` result) and whether the
+        source can be decoded on the device, built once per run instead of
+        for every file."""
+        key = (encoder, hdr, device_decode)
+        if key in self._encode_templates:
+            return self._encode_templates[key]
 
         input_options = {
             "y": None,
             "v": "fatal",
-            "stats": None,
+            "nostats": None,
             "hide_banner": None,
         }
 
         output_options = {
-            DuplicateString("metadata"): f"title={title}",
-            DuplicateString("metadata"): f"year={release_year}",
             "map_chapters": 0,
             "map_metadata": -1,
-            "metadata:s:a:0": f"language={language}",
             "profile:v": "main10",
             "pix_fmt:v": "yuv420p10le",
             "preset:v": "veryfast",
             "crf": 20,
             "movflags": "+faststart",
-            "vf": f"scale={width}:-2:flags=lanczos",
-            "x265-params": "frame-threads=0",
-            DuplicateString("map"): "0:v",
-            DuplicateString("map"): f"0:a:{track}",
             "c:a": "aac",
             "c:v": "libx265",
         }
 
-        if dynamic_hdr is not None:
-            if dynamic_hdr:
-                output_options["x265-params"] = (
+        x265_params = "frame-threads=0"
+        if hdr is not None:
+            if hdr:
+                # the per file dhdr10-info is appended in _encode_video
+                x265_params = (
                     "colorprim=bt2020:transfer=smpte2084:colormatrix=bt2020nc:"
                     "master-display=G(13250,34500)B(7500,3000)R(34000,16000)WP(15635,16450)L(10000000,1):"
-                    "max-cll=1016,115:hdr10=1:frame-threads=0:dhdr10-info=/tmp/metadata.json"
+                    "max-cll=1016,115:hdr10=1:frame-threads=0"
                 )
             else:
-                output_options["x265-params"] = (
+                x265_params = (
                     "hdr-opt=1:repeat-headers=1:colorprim=bt2020:transfer=smpte2084:colormatrix=bt2020nc:frame-threads=0:"
                     "master-display=G(8500,39850)B(6550,2300)R(35400,14600)WP(15635,16450)L(40000000,50):max-cll=0,0"
                 )
-
-        seek = False
-        if self.sample and not from_path.endswith("p.mp4"):
-            input_options["ss"] = "00:03:30"
-            input_options["t"] = 30
-            total_duration = 30_000_000
-            seek = True
+        scale = "scale={width}:-2:flags=lanczos"
+
+        hardware = self.hardware_encoders.get(encoder)
+        if hardware is not None:
+            for option in ("preset:v", "crf"):
+                del output_options[option]
+            x265_params = None
+            if hardware["scale_filter"] is None:
+                input_options.update(hardware["input_options"])
+            elif device_decode:
+                input_options.update(hardware["input_options"])
+                # the pixel format is picked by the scale filter on the device
+                del output_options["pix_fmt:v"]
+                scale = (
+                    f"{hardware['scale_filter']}={{width}}:-2:"
+                    f"format={hardware['scale_format']}"
+                )
+            else:
+                input_options.update(hardware["software_input_options"])
+                del output_options["pix_fmt:v"]
+                scale = hardware["software_scale"]
+            output_options.update(hardware["output_options"])
+            output_options["c:v"] = encoder
+            if hdr is not None:
+                # static HDR10, tag the stream since x265-params do not apply
+                output_options["color_primaries:v"] = "bt2020"
+                output_options["color_trc:v"] = "smpte2084"
+                output_options["colorspace:v"] = "bt2020nc"
 
         if self.threads > 0:
             output_options["threads"] = self.threads
 
-        with show_progress(total_duration, self, seek=seek) as socket_filename:
-            try:
-                stream = ffmpeg.input(from_path, **input_options).output(
-                    to_path, **output_options
-                )
-
-                if self.dry_run:
-                    self._log(" ".join(stream.compile()))
-                    if self.fake:
-                        import time
-
-                        bar = pacbar(length=5)
-                        for x in range(5):
-                            time.sleep(1)
-                            bar.update(1)
-                        bar.render_finish()
-                else:
-                    (
-                        stream.global_args(
-                            "-progress", "unix://{}".format(socket_filename)
-                        ).run(capture_stdout=True, capture_stderr=True)
-                    )
-            except ffmpeg.Error as e:
-                print("ffmpeg error")
-                print(e.stderr, file=sys.stderr)
-                sys.exit(1)
-
-            try:
-                socket_filename.close()
-            except AttributeError:
-                pass
+        template = {
+            "input_args": _to_args(input_options),
+            "output_args": _to_args(output_options),
+            "x265_params": x265_params,
+            "scale": scale,
+        }
+        self._encode_templates[key] = template
+        return template
 
-    def _run(self, statement):
+    def _run(self, func, *args):
         if self.verbose:
-            self._log(statement)
+            self._log(f"{func.__name__}{args!r}")
         if not self.dry_run:
-            eval(statement)
+            func(*args)
 
     def process(self):
-        self._log(f"Processing movies\n")
-        self._find_files()
-        self._process_files()
-        self._log("\n")
+        flusher = gevent.spawn(self._flush_log_loop)
+        try:
+            self._log(f"Processing movies\n")
+            self._find_files()
+            self._process_files()
+            self._log("\n")
+        finally:
+            flusher.kill()
+            self._flush_log()
 
 
 @click.command()
@@ -701,6 +1126,43 @@ class Processor(object):
     type=int,
     default=0,
 )
+@click.option(
+    "-j",
+    "--jobs",
+    help=(
+        "Number of files to encode in parallel, defaults to the CPU count "
+        "divided by --threads (or 1 if --threads is not set)"
+    ),
+    type=int,
+    default=0,
+)
+@click.option(
+    "--highest-only",
+    help=(
+        "Only encode the highest resolution the source supports instead of "
+        "every resolution at or below it"
+    ),
+    is_flag=True,
+)
+@click.option(
+    "-e",
+    "--encoder",
+    help=(
+        "HEVC encoder to use, defaults to the first working NVENC, QSV or "
+        "VideoToolbox encoder, falling back to libx265"
+    ),
+    type=click.Choice(
+        [
+            "auto",
+            "libx265",
+            "hevc_nvenc",
+            "hevc_qsv",
+            "hevc_vaapi",
+            "hevc_videotoolbox",
+        ]
+    ),
+    default="auto",
+)
 def main(*args, **kwargs):
     """Processes files in given directory"""
 
@@ -713,8 +1175,13 @@ def main(*args, **kwargs):
         kwargs["path"] = os.path.join(base_path)
     if base_output_path is not None:
         kwargs["output_path"] = os.path.join(base_output_path)
-    processor = Processor(*args, **kwargs)
-    processor.process()
+    lock_file = _acquire_lock("movies")
+    processor = Processor(*args, lock_file=lock_file, **kwargs)
+    try:
+        processor.process()
+    except ffmpeg.Error:
+        # already reported by the failing file
+        sys.exit(1)
 
 
 if __name__ == "__main__":